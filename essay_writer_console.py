@@ -1,12 +1,25 @@
 from dotenv import load_dotenv
+import asyncio
+import hashlib
+import json
 import os
-import requests
+import re
+import threading
+import time
+import orjson
+import diskcache
+import httpx
+import numpy as np
 from langgraph.graph import StateGraph, END
-from typing import TypedDict, List
+from typing import TypedDict, List, Optional
 from langchain_core.messages import SystemMessage, HumanMessage
-from tavily import TavilyClient
 import logging
 
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # Optional, only needed for the semantic search cache
+    SentenceTransformer = None
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
@@ -21,15 +34,33 @@ class AgentState(TypedDict):
     content: List[str]
     revision_number: int
     max_revisions: int
+    score: int
+    prefetch: Optional[asyncio.Task]
+
+# Tavily search API setup
+TAVILY_API_URL = "https://api.tavily.com/search"
+TAVILY_API_KEY = os.environ["TAVILY_API_KEY"]
+
+# Shared HTTP client for all outbound calls. Connections are kept alive, and
+# over HTTPS concurrent requests to one host are multiplexed on a single
+# HTTP/2 connection.
+HTTP_CLIENT = httpx.AsyncClient(
+    timeout=30,
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64)
+    )
+)
 
-# Set up Tavily client
-tavily = TavilyClient(api_key=os.environ["TAVILY_API_KEY"])
+# JSON request bodies are serialized with orjson and sent as raw bytes
+JSON_HEADERS = {"Content-Type": "application/json"}
 
 # Google Custom Search API setup
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 GOOGLE_CSE_ID = os.environ.get("GOOGLE_CSE_ID")
 
-def google_search(query, max_results=2):
+async def google_search(query, max_results=2):
     """Perform a search using Google Custom Search JSON API."""
     url = "https://www.googleapis.com/customsearch/v1"
     params = {
@@ -39,56 +70,397 @@ def google_search(query, max_results=2):
         "num": max_results
     }
     try:
-        response = requests.get(url, params=params)
+        response = await HTTP_CLIENT.get(url, params=params)
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
     except Exception as e:
         logger.error(f"Google Search failed for query '{query}': {e}")
         return None
 
-def search_with_fallback(query, max_results=2):
-    """Search using Tavily, fallback to Google if Tavily fails."""
+class SemanticSearchCache:
+    """Reuse search results for queries that paraphrase an earlier query.
+
+    Queries are embedded with a small sentence-transformers model and compared
+    by cosine similarity against all cached queries. Entries are appended to a
+    JSON lines file under ``path`` so the cache survives between runs; only the
+    newest ``max_entries`` are kept, and entries older than ``ttl`` seconds are
+    dropped. Embedding runs in a worker thread so it does not block the event
+    loop.
+    """
+
+    def __init__(self, path, threshold=0.92, ttl=86400, max_entries=1000,
+                 model_name="sentence-transformers/all-MiniLM-L6-v2"):
+        self.path = path
+        self.file = os.path.join(path, "entries.jsonl")
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.model_name = model_name
+        self.model = None
+        self._model_lock = threading.Lock()
+        self.embeddings = None
+        self.entries = []
+        self._lines_on_disk = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.file):
+            return
+        entries = []
+        try:
+            with open(self.file, "rb") as f:
+                for line in f:
+                    try:
+                        entries.append(orjson.loads(line))
+                    except orjson.JSONDecodeError:
+                        continue
+        except OSError as e:
+            logger.error(f"Could not load semantic search cache: {e}")
+            return
+        self._lines_on_disk = len(entries)
+        self._set_entries(entries)
+        if self._lines_on_disk > len(self.entries):
+            self._compact()
+
+    def _set_entries(self, entries):
+        cutoff = time.time() - self.ttl
+        entries = [e for e in entries if e.get("created", 0) >= cutoff]
+        self.entries = entries[-self.max_entries:]
+        if self.entries:
+            self.embeddings = np.array([e["embedding"] for e in self.entries], dtype=np.float32)
+        else:
+            self.embeddings = None
+
+    def _compact(self):
+        """Rewrite the cache file with only the entries kept in memory."""
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.file, "wb") as f:
+            for entry in self.entries:
+                f.write(orjson.dumps(entry, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n")
+        self._lines_on_disk = len(self.entries)
+
+    def _embed(self, query):
+        with self._model_lock:
+            if self.model is None:
+                self.model = SentenceTransformer(self.model_name)
+        return self.model.encode(query, normalize_embeddings=True).astype(np.float32)
+
+    async def get(self, query, max_results):
+        """Return cached results for a similar query, or None."""
+        if self.entries and self.entries[0]["created"] < time.time() - self.ttl:
+            self._set_entries(self.entries)
+            self._compact()
+        if not self.entries:
+            return None
+        embedding = await asyncio.to_thread(self._embed, query)
+        sims = self.embeddings @ embedding
+        best = int(sims.argmax())
+        entry = self.entries[best]
+        if sims[best] < self.threshold or entry["max_results"] < max_results:
+            return None
+        logger.info(f"Semantic cache hit for '{query}' (matched '{entry['query']}', similarity {sims[best]:.2f}).")
+        return entry["results"][:max_results]
+
+    async def add(self, query, max_results, results):
+        """Store the results for a query and append them to the cache file."""
+        embedding = await asyncio.to_thread(self._embed, query)
+        entry = {
+            "query": query,
+            "max_results": max_results,
+            "results": results,
+            "embedding": embedding,
+            "created": time.time()
+        }
+        self._set_entries([*self.entries, entry])
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.file, "ab") as f:
+            f.write(orjson.dumps(entry, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n")
+        self._lines_on_disk += 1
+        if self._lines_on_disk > 2 * self.max_entries:
+            self._compact()
+
+# Seconds cached search results stay valid, in both search caches
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", str(86400)))
+SEARCH_SEMANTIC_THRESHOLD = float(os.environ.get("SEARCH_SEMANTIC_THRESHOLD", "0.92"))
+if SentenceTransformer is not None:
+    semantic_cache = SemanticSearchCache(
+        ".search_semantic_cache", threshold=SEARCH_SEMANTIC_THRESHOLD, ttl=SEARCH_CACHE_TTL
+    )
+else:
+    logger.info("sentence-transformers not installed; semantic search cache disabled.")
+    semantic_cache = None
+
+# On-disk cache of search results keyed by the exact query
+search_cache = diskcache.Cache(".search_cache")
+
+async def search_with_fallback_async(query, max_results=2):
+    """Search using Tavily, fallback to Google if Tavily fails.
+
+    Results for a query seen before are served from the search cache, and
+    results for queries similar to an earlier one from the semantic cache,
+    both without any network call. The semantic cache is optional: if it
+    fails (e.g. the embedding model cannot be loaded) it is disabled for the
+    rest of the run and searches go on without it.
+    """
+    global semantic_cache
     logger.info(f"Searching for: {query}")
 
-    # Try Tavily first
+    key = hashlib.sha256(f"{query}|{max_results}".encode()).hexdigest()
+    cached = search_cache.get(key)
+    if cached is not None:
+        logger.info(f"Using cached search results for '{query}'.")
+        return cached
+
+    if semantic_cache is not None:
+        try:
+            cached = await semantic_cache.get(query, max_results)
+        except Exception as e:
+            logger.error(f"Semantic search cache failed, disabling it: {e}")
+            semantic_cache = None
+            cached = None
+        if cached is not None:
+            return cached
+
+    results = await _search_uncached(query, max_results=max_results)
+    if results:
+        search_cache.set(key, results, expire=SEARCH_CACHE_TTL)
+        if semantic_cache is not None:
+            try:
+                await semantic_cache.add(query, max_results, results)
+            except Exception as e:
+                logger.error(f"Semantic search cache failed, disabling it: {e}")
+                semantic_cache = None
+    return results
+
+# Seconds Tavily gets to answer before Google is queried in parallel
+SEARCH_HEDGE_DELAY = float(os.environ.get("SEARCH_HEDGE_DELAY", "2"))
+
+async def tavily_search(query, max_results=2):
+    """Search using Tavily, returning the result snippets (empty on failure)."""
     try:
         logger.info("Trying Tavily...")
-        search_response = tavily.search(query=query, max_results=max_results)
+        response = await HTTP_CLIENT.post(
+            TAVILY_API_URL,
+            content=orjson.dumps({"query": query, "max_results": max_results}),
+            headers={**JSON_HEADERS, "Authorization": f"Bearer {TAVILY_API_KEY}"}
+        )
+        response.raise_for_status()
+        search_response = orjson.loads(response.content)
         results = search_response.get('results', [])
         if results:
             logger.info("Tavily search successful.")
             return [r['content'] for r in results]
     except Exception as e:
         logger.error(f"Tavily search failed: {e}")
+    return []
 
-    # Fallback to Google if Tavily fails
-    if GOOGLE_API_KEY and GOOGLE_CSE_ID:
-        logger.info("Falling back to Google Search...")
-        search_response = google_search(query, max_results=max_results)
-        if search_response:
-            results = search_response.get('items', [])
-            if results:
-                logger.info("Google Search successful.")
-                return [r.get('snippet', '') for r in results]
-
-    logger.warning("Both Tavily and Google Search failed.")
+async def google_snippets(query, max_results=2):
+    """Search using Google, returning the result snippets (empty on failure)."""
+    search_response = await google_search(query, max_results=max_results)
+    if search_response:
+        results = search_response.get('items', [])
+        if results:
+            logger.info("Google Search successful.")
+            return [r.get('snippet', '') for r in results]
     return []
 
-# Define API endpoint for Mistral model
-MISTRAL_API_URL = "http://localhost:4000/v1/completions"
+async def _search_uncached(query, max_results=2):
+    """Search using Tavily, racing Google against it if Tavily is slow or fails.
 
-def call_mistral_api(messages):
-    """Call the Mistral API."""
-    prompt = "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages])
+    Google is only queried once Tavily has failed or has not answered within
+    SEARCH_HEDGE_DELAY seconds, which keeps Google quota usage low. From then
+    on the first non-empty result wins, Tavily's if both are ready, and the
+    other request is cancelled.
+    """
+    tavily_task = asyncio.create_task(tavily_search(query, max_results=max_results))
+    google_task = None
     try:
-        response = requests.post(MISTRAL_API_URL, json={"prompt": prompt})
+        if not (GOOGLE_API_KEY and GOOGLE_CSE_ID):
+            results = await tavily_task
+            if not results:
+                logger.warning("Tavily search failed and Google Search is not configured.")
+            return results
+
+        await asyncio.wait({tavily_task}, timeout=SEARCH_HEDGE_DELAY)
+        if tavily_task.done() and tavily_task.result():
+            return tavily_task.result()
+
+        if tavily_task.done():
+            logger.info("Falling back to Google Search...")
+        else:
+            logger.info("Tavily is slow; racing Google Search against it...")
+        google_task = asyncio.create_task(google_snippets(query, max_results=max_results))
+        pending = {tavily_task, google_task}
+        results = []
+        while pending and not results:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda t: t is not tavily_task):
+                if task.result():
+                    results = task.result()
+                    break
+        for task in pending:
+            task.cancel()
+
+        if not results:
+            logger.warning("Both Tavily and Google Search failed.")
+        return results
+    except asyncio.CancelledError:
+        # asyncio.wait does not propagate cancellation to the tasks it waits on
+        for task in (tavily_task, google_task):
+            if task is not None:
+                task.cancel()
+        raise
+
+async def search_all(queries, max_results=2):
+    """Run the searches for all queries concurrently and flatten the results."""
+    searches = {q: search_with_fallback_async(q, max_results=max_results) for q in queries}
+    return await collect_searches(searches)
+
+async def collect_searches(searches):
+    """Await already dispatched searches, given as a query -> awaitable dict, and flatten the results."""
+    results = await asyncio.gather(*searches.values(), return_exceptions=True)
+    content = []
+    for q, r in zip(searches, results):
+        if isinstance(r, Exception):
+            logger.error(f"Search failed for query '{q}': {r}")
+            continue
+        content.extend(r)
+    return content
+
+# Upper bound on the research content passed to the writer, in characters
+MAX_CONTENT_CHARS = int(os.environ.get("MAX_CONTENT_CHARS", "24000"))
+
+def merge_content(content, new_content):
+    """Add new search results to the content, dropping duplicates.
+
+    The oldest snippets are dropped once the content exceeds MAX_CONTENT_CHARS,
+    so the writer prompt stays bounded across revisions.
+    """
+    merged = list(dict.fromkeys(c for c in [*(content or []), *new_content] if c))
+    total = sum(map(len, merged))
+    while len(merged) > 1 and total > MAX_CONTENT_CHARS:
+        total -= len(merged.pop(0))
+    return merged
+
+# Define API endpoint for Mistral model (OpenAI-compatible chat endpoint of the LiteLLM server)
+MISTRAL_API_URL = "http://localhost:4000/v1/chat/completions"
+MISTRAL_MODEL = os.environ.get("MISTRAL_MODEL", "mistral")
+# Long completions can take minutes before the first byte of a non-streamed response
+MISTRAL_TIMEOUT = httpx.Timeout(30, read=300)
+
+# Maximum number of concurrent Mistral requests; match the server's parallel slots
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "2"))
+_llm_semaphore = None
+
+def llm_semaphore():
+    """Return the semaphore bounding concurrent Mistral requests.
+
+    Created lazily so it belongs to the event loop started by asyncio.run().
+    """
+    global _llm_semaphore
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    return _llm_semaphore
+
+# On-disk cache of Mistral responses keyed by the prompt; set LLM_CACHE=0 to disable
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE", "1") != "0"
+LLM_CACHE_TTL = 7 * 86400
+llm_cache = diskcache.Cache(".llm_cache") if LLM_CACHE_ENABLED else None
+
+def _cache_key(messages):
+    payload = {"model": MISTRAL_MODEL, "messages": messages}
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def completion_text(response):
+    """Return the assistant message text of a chat completion response."""
+    return response['choices'][0]['message']['content']
+
+async def call_mistral_api(messages):
+    """Call the Mistral API, serving repeated prompts from the response cache."""
+    if llm_cache is None:
+        return await _call_mistral_api(messages)
+
+    key = _cache_key(messages)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        logger.info("Using cached Mistral response.")
+        return cached
+
+    response = await _call_mistral_api(messages)
+    choices = response.get('choices') if isinstance(response, dict) else None
+    if choices and (choices[0].get('message') or {}).get('content'):
+        llm_cache.set(key, response, expire=LLM_CACHE_TTL)
+    else:
+        logger.warning("Mistral response has no completion text; not caching it.")
+    return response
+
+async def _call_mistral_api(messages):
+    """Send the messages to the Mistral API."""
+    try:
+        async with llm_semaphore():
+            response = await HTTP_CLIENT.post(
+                MISTRAL_API_URL,
+                content=orjson.dumps({"model": MISTRAL_MODEL, "messages": messages}),
+                headers=JSON_HEADERS,
+                timeout=MISTRAL_TIMEOUT
+            )
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.HTTPError as e:
+        return orjson.loads(response.content)
+    except httpx.HTTPStatusError as e:
         logger.error(f"HTTP Error: {e}")
         logger.error(f"Response: {e.response.text}")
         raise
 
+async def stream_mistral_api(messages):
+    """Stream the Mistral completion for the messages, yielding text as it arrives.
+
+    Uses the OpenAI-style server-sent events of the chat completions endpoint. A
+    cached response is yielded in one piece, and a stream that finished with
+    ``[DONE]`` and produced text is written to the same cache as call_mistral_api.
+    """
+    key = _cache_key(messages) if llm_cache is not None else None
+    if key is not None:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            logger.info("Using cached Mistral response.")
+            yield completion_text(cached)
+            return
+
+    chunks = []
+    done = False
+    payload = {"model": MISTRAL_MODEL, "messages": messages, "stream": True}
+    async with llm_semaphore(), HTTP_CLIENT.stream(
+        "POST", MISTRAL_API_URL, content=orjson.dumps(payload),
+        headers={**JSON_HEADERS, "Accept": "text/event-stream"},
+        timeout=MISTRAL_TIMEOUT
+    ) as response:
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            await response.aread()
+            logger.error(f"HTTP Error: {e}")
+            logger.error(f"Response: {response.text}")
+            raise
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                done = True
+                break
+            choices = orjson.loads(data).get('choices') or [{}]
+            text = (choices[0].get('delta') or {}).get('content') or ""
+            if text:
+                chunks.append(text)
+                yield text
+
+    if not done:
+        logger.warning("Mistral stream ended without [DONE]; not caching the truncated response.")
+    elif key is not None and chunks:
+        message = {"role": "assistant", "content": "".join(chunks)}
+        llm_cache.set(key, {"choices": [{"message": message}]}, expire=LLM_CACHE_TTL)
+
 PLAN_PROMPT = """You are an expert writer tasked with writing a high-level outline of an essay.
 Write such an outline for the user provided topic. Give an outline of the essay along with any relevant notes
 or instructions for the sections."""
@@ -96,106 +468,258 @@ or instructions for the sections."""
 WRITER_PROMPT = """You are an essay assistant tasked with writing excellent 5-paragraph essays.
 Generate the best essay possible for the user's request and the initial outline.
 If the user provides critique, respond with a revised version of your previous attempts.
-Utilize all the information below as needed:
+Utilize all the reference material provided by the user as needed."""
 
-------
-
-{content}"""
-
-REFLECTION_PROMPT = """You are a teacher grading an essay submission.
+REFLECT_AND_RESEARCH_PROMPT = """You are a teacher grading an essay submission.
 Generate critique and recommendations for the user's submission.
-Provide detailed recommendations, including requests for length, depth, style, etc."""
+Provide detailed recommendations, including requests for length, depth, style, etc.
+Grade the submission with an integer score from 0 (unusable) to 10 (no changes needed).
+Also generate a list of search queries that will gather any information needed
+to make the requested revisions. Only generate 3 queries max.
+Return exactly a JSON object of the form
+{"critique": "...", "score": 0, "queries": ["...", "...", "..."]}, no prose."""
+
+# Drafts graded at least this score by the reflection are accepted without further revisions
+QUALITY_THRESHOLD = int(os.environ.get("QUALITY_THRESHOLD", "9"))
 
 RESEARCH_PLAN_PROMPT = """You are a researcher charged with providing information that can
 be used when writing the following essay. Generate a list of search queries that will gather
-any relevant information. Only generate 3 queries max."""
+any relevant information. Only generate 3 queries max.
+Return exactly a JSON array of 3 query strings, no prose."""
+
+
+# strict=False accepts raw newlines inside strings, which models often emit
+_JSON_DECODER = json.JSONDecoder(strict=False)
+
+def parse_queries(text, max_queries=3):
+    """Parse the JSON array of search queries returned by the model.
+
+    Every ``[`` in the response is tried as the start of the array, so brackets
+    in preamble prose do not hide it. If no array of strings is found, falls
+    back to one query per line, skipping preamble lines ending in a colon and
+    anything that looks like JSON.
+    """
+    for match in re.finditer(r'\[', text):
+        try:
+            queries, _ = _JSON_DECODER.raw_decode(text, match.start())
+        except json.JSONDecodeError:
+            continue
+        if isinstance(queries, list):
+            queries = [q.strip() for q in queries if isinstance(q, str) and q.strip()]
+            if queries:
+                return queries[:max_queries]
+
+    logger.warning("Research queries were not a JSON array; splitting on lines instead.")
+    queries = []
+    for line in text.split('\n'):
+        line = re.sub(r'^(?:[-*]|\d+[.)])\s+', '', line.strip()).strip()
+        if not line or line.endswith(':') or line[0] in '[{' or line[-1] in ']}':
+            continue
+        queries.append(line.strip('"').strip())
+    return [q for q in queries if q][:max_queries]
+
+def parse_json_object(text):
+    """Parse the JSON object in a model response, or return None if there is none.
+
+    Every ``{`` in the response is tried as the start of the object, so braces
+    in surrounding prose do not hide it.
+    """
+    for match in re.finditer(r'\{', text):
+        try:
+            data, _ = _JSON_DECODER.raw_decode(text, match.start())
+        except json.JSONDecodeError:
+            continue
+        if isinstance(data, dict):
+            return data
+    return None
+
+def parse_score(value):
+    """Return the integer score from a reflection, accepting forms like ``8`` or ``"8/10"``.
+
+    Anything without a leading number counts as 0.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    match = re.match(r'\s*(\d+)', str(value)) if isinstance(value, str) else None
+    return int(match.group(1)) if match else 0
+
+def _array_strings(text, start):
+    """Scan the JSON array opening at ``text[start]`` in a possibly partial response.
+
+    Returns the complete string elements at the top level of the array (nested
+    values such as object keys are skipped) and whether the array is closed.
+    """
+    strings = []
+    depth = 0
+    i = start
+    while i < len(text):
+        ch = text[i]
+        if ch == '"':
+            end = i + 1
+            while end < len(text) and text[end] != '"':
+                end += 2 if text[end] == '\\' else 1
+            if end >= len(text):
+                return strings, False
+            if depth == 1:
+                try:
+                    value = json.loads(text[i:end + 1])
+                except json.JSONDecodeError:
+                    value = None
+                if isinstance(value, str) and value.strip():
+                    strings.append(value.strip())
+            i = end + 1
+            continue
+        if ch in '[{':
+            depth += 1
+        elif ch in ']}':
+            depth -= 1
+            if depth == 0:
+                return strings, True
+        i += 1
+    return strings, False
+
+def streamed_queries(text):
+    """Return the queries already complete in a partial response.
+
+    Mirrors parse_queries: only top-level strings of the first array that
+    contains any are returned.
+    """
+    for match in re.finditer(r'\[', text):
+        strings, closed = _array_strings(text, match.start())
+        if strings or not closed:
+            return strings
+    return []
 
-RESEARCH_CRITIQUE_PROMPT = """You are a researcher charged with providing information that can
-be used when making any requested revisions (as outlined below).
-Generate a list of search queries that will gather any relevant information. Only generate 3 queries max."""
+async def plan_node(state: AgentState):
+    """Generate an essay plan.
 
-def plan_node(state: AgentState):
-    """Generate an essay plan."""
+    A search for the raw task is started speculatively while the plan is
+    generated, and handed to research_plan_node through the state.
+    """
     logger.info("Running plan_node...")
+    prefetch = asyncio.create_task(search_with_fallback_async(state['task'], max_results=2))
     messages = [
         {"role": "system", "content": PLAN_PROMPT},
         {"role": "user", "content": state['task']}
     ]
-    response = call_mistral_api(messages)
-    return {"plan": response['choices'][0]['text']}
+    try:
+        response = await call_mistral_api(messages)
+    except BaseException:
+        prefetch.cancel()
+        raise
+    return {"plan": completion_text(response), "prefetch": prefetch}
+
+async def research_plan_node(state: AgentState):
+    """Generate research queries and perform searches.
 
-def research_plan_node(state: AgentState):
-    """Generate research queries and perform searches."""
+    The queries are streamed and each search starts as soon as its query is
+    complete, while the model is still generating the remaining ones. The
+    results of the search prefetched by plan_node are merged in as well.
+    """
     logger.info("Running research_plan_node...")
     messages = [
         {"role": "system", "content": RESEARCH_PLAN_PROMPT},
         {"role": "user", "content": state['task']}
     ]
-    response = call_mistral_api(messages)
 
-    queries = [q.strip() for q in response['choices'][0]['text'].split('\n') if q.strip()]
-    logger.info(f"Generated research queries: {queries}")
+    prefetch = state.get('prefetch')
+    searches = {}
+
+    def dispatch(queries):
+        for q in queries:
+            if q not in searches and len(searches) < 3:  # Limit to 3 queries
+                searches[q] = asyncio.create_task(search_with_fallback_async(q, max_results=2))
 
-    content = state['content'] or []
-    for q in queries[:3]:  # Limit to 3 queries
-        search_results = search_with_fallback(q, max_results=2)
-        content.extend(search_results)
+    text = ""
+    try:
+        async for token in stream_mistral_api(messages):
+            text += token
+            dispatch(streamed_queries(text))
+    except BaseException:
+        for task in [*searches.values(), *([prefetch] if prefetch else [])]:
+            task.cancel()
+        raise
+
+    dispatch(parse_queries(text))
+    logger.info(f"Generated research queries: {list(searches)}")
+
+    if prefetch is not None:
+        if state['task'] in searches:
+            prefetch.cancel()
+        else:
+            searches = {state['task']: prefetch, **searches}
+
+    content = merge_content(state['content'], await collect_searches(searches))
 
-    return {"content": content}
+    return {"content": content, "prefetch": None}
 
-def generation_node(state: AgentState):
+async def generation_node(state: AgentState):
     """Generate the essay draft."""
     logger.info("Running generation_node...")
+    # Messages are ordered from most to least stable: the constant system prompt,
+    # then the task and plan (fixed for the run) followed by the research content
+    # (which grows between revisions), then on revisions the previous draft and
+    # its critique.
     content = "\n\n".join(state['content'] or [])
     user_message = {
         "role": "user",
-        "content": f"{state['task']}\n\nHere is my plan:\n\n{state['plan']}"
+        "content": f"{state['task']}\n\nHere is my plan:\n\n{state['plan']}\n\nReference material:\n\n------\n\n{content}"
     }
 
     messages = [
-        {"role": "system", "content": WRITER_PROMPT.format(content=content)},
+        {"role": "system", "content": WRITER_PROMPT},
         user_message
     ]
+    # On revisions, show the writer its previous draft and the critique of it
+    if state.get('draft') and state.get('critique'):
+        messages += [
+            {"role": "assistant", "content": state['draft']},
+            {"role": "user", "content": f"Here is my critique of this draft:\n\n{state['critique']}"}
+        ]
 
-    response = call_mistral_api(messages)
+    response = await call_mistral_api(messages)
 
     return {
-        "draft": response['choices'][0]['text'],
+        "draft": completion_text(response),
         "revision_number": state.get("revision_number", 1) + 1
     }
 
-def reflection_node(state: AgentState):
-    """Generate critique for the essay draft."""
-    logger.info("Running reflection_node...")
-    messages = [
-        {"role": "system", "content": REFLECTION_PROMPT},
-        {"role": "user", "content": state['draft']}
-    ]
-
-    response = call_mistral_api(messages)
+async def reflect_and_research_node(state: AgentState):
+    """Critique the essay draft and search for material for the revision in one LLM call.
 
-    return {"critique": response['choices'][0]['text']}
-
-def research_critique_node(state: AgentState):
-    """Generate research queries based on critique and perform searches."""
-    logger.info("Running research_critique_node...")
+    No searches are run if the draft scores at least QUALITY_THRESHOLD, since
+    it will not be revised.
+    """
+    logger.info("Running reflect_and_research_node...")
     messages = [
-        {"role": "system", "content": RESEARCH_CRITIQUE_PROMPT},
-        {"role": "user", "content": state['critique']}
+        {"role": "system", "content": REFLECT_AND_RESEARCH_PROMPT},
+        {"role": "user", "content": state['draft']}
     ]
 
-    response = call_mistral_api(messages)
-
-    queries = [q.strip() for q in response['choices'][0]['text'].split('\n') if q.strip()]
+    response = await call_mistral_api(messages)
+    text = completion_text(response)
+
+    data = parse_json_object(text)
+    if data is None:
+        logger.warning("Reflection was not valid JSON; using the raw response as critique.")
+        data = {"critique": text, "queries": []}
+    critique = str(data.get("critique") or text)
+    score = parse_score(data.get("score"))
+    logger.info(f"Draft scored {score}/10.")
+    if score >= QUALITY_THRESHOLD:
+        return {"critique": critique, "score": score}
+
+    queries = data.get("queries")
+    if isinstance(queries, str):
+        queries = [queries]
+    elif not isinstance(queries, list):
+        queries = []
+    queries = [q.strip() for q in queries if isinstance(q, str) and q.strip()][:3]
     logger.info(f"Generated research queries: {queries}")
 
-    content = state['content'] or []
+    content = merge_content(state['content'], await search_all(queries, max_results=2))
 
-    for q in queries[:3]:  # Limit to 3 queries
-        search_results = search_with_fallback(q, max_results=2)
-        content.extend(search_results)
-
-    return {"content": content}
+    return {"critique": critique, "score": score, "content": content}
 
 def should_continue(state):
     """Determine if the graph should continue or end."""
@@ -203,29 +727,38 @@ def should_continue(state):
         logger.info("Max revisions reached. Ending graph.")
         return END
     logger.info("Continuing to next revision.")
-    return "reflect"
+    return "reflect_and_research"
+
+def should_revise(state):
+    """Determine if the draft needs another revision or is good enough."""
+    if state["score"] >= QUALITY_THRESHOLD:
+        logger.info("Draft meets the quality threshold. Ending graph.")
+        return END
+    return "generate"
 
 builder = StateGraph(AgentState)
 builder.add_node("planner", plan_node)
 builder.add_node("generate", generation_node)
-builder.add_node("reflect", reflection_node)
 builder.add_node("research_plan", research_plan_node)
-builder.add_node("research_critique", research_critique_node)
+builder.add_node("reflect_and_research", reflect_and_research_node)
 builder.set_entry_point("planner")
 builder.add_conditional_edges(
     "generate",
     should_continue,
-    {END: END, "reflect": "reflect"}
+    {END: END, "reflect_and_research": "reflect_and_research"}
 )
 builder.add_edge("planner", "research_plan")
 builder.add_edge("research_plan", "generate")
-builder.add_edge("reflect", "research_critique")
-builder.add_edge("research_critique", "generate")
+builder.add_conditional_edges(
+    "reflect_and_research",
+    should_revise,
+    {END: END, "generate": "generate"}
+)
 
 graph = builder.compile()
 
 # Main function to run the script
-def main():
+async def main():
     # Ask for the essay topic in the console
     essay_topic = input("Enter the essay topic: ").strip()
     if not essay_topic:
@@ -234,15 +767,20 @@ def main():
 
     max_revisions = 3
     logger.info("Starting essay generation process...")
-    result = graph.invoke({
-        "task": essay_topic,
-        "max_revisions": max_revisions,
-        "revision_number": 0,
-        "content": [],
-        "plan": "",
-        "draft": "",
-        "critique": ""
-    })
+    try:
+        result = await graph.ainvoke({
+            "task": essay_topic,
+            "max_revisions": max_revisions,
+            "revision_number": 0,
+            "content": [],
+            "plan": "",
+            "draft": "",
+            "critique": "",
+            "score": 0,
+            "prefetch": None
+        })
+    finally:
+        await HTTP_CLIENT.aclose()
 
     logger.info("Essay generation complete.")
     print("\nFinal Essay:")
@@ -250,4 +788,4 @@ def main():
 
 # Run the script
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())